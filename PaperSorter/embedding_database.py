@@ -36,24 +36,34 @@ class EmbeddingDatabase:
             self.db.close()
 
     def __len__(self):
-        return sum(1 for _ in self.db.iterator())
+        return sum(1 for _ in self.db.iterator(include_value=False))
 
     def __contains__(self, item):
         v = self.db.get(item.encode())
         return v is not None
 
     def keys(self):
-        return set([key.decode() for key, _ in self.db.iterator()])
+        return set([key.decode() for key in self.db.iterator(include_value=False)])
 
     def __getitem__(self, key):
         if isinstance(key, str):
             return np.frombuffer(self.db.get(key.encode()), dtype=self.dtype)
-        elif isinstance(key, list):
-            return np.array([
-                np.frombuffer(self.db.get(k.encode()), dtype=self.dtype)
-                for k in key])
+        elif isinstance(key, (list, tuple)):
+            values = [self.db.get(k.encode()) for k in key]
+            if not values:
+                return np.empty((0, 0), dtype=self.dtype)
+
+            # Copy the stored bytes straight into one preallocated matrix
+            # instead of stacking a temporary array per row.
+            rowsize = len(values[0])
+            matrix = np.empty((len(values), rowsize // np.dtype(self.dtype).itemsize),
+                              dtype=self.dtype)
+            buf = memoryview(matrix).cast('B')
+            for i, value in enumerate(values):
+                buf[i * rowsize:(i + 1) * rowsize] = value
+            return matrix
         else:
-            raise TypeError('Key should be str or list of str.')
+            raise TypeError('Key should be str or list/tuple of str.')
 
     def __setitem__(self, key, value):
         if not isinstance(value, np.ndarray):
@@ -23,6 +23,8 @@
 
 import sqlite3
 import pandas as pd
+import json
+import string
 import re
 
 class FeedDatabase:
@@ -37,10 +39,21 @@ class FeedDatabase:
                 'published', 'link', 'mediaUrl', 'label', 'score', 'broadcasted',
                 'tldr']
 
+    # Keep IN (...) lists below SQLITE_MAX_VARIABLE_NUMBER of old SQLite builds.
+    max_query_params = 500
+
+    # Room for the fixed statements plus the IN (...) variants of different
+    # lengths, so that none of them is evicted and re-prepared on the hot path.
+    statement_cache_size = 512
+
+    # Recorded in PRAGMA user_version; see migrate_schema().
+    schema_version = 1
+
     def __init__(self, filename):
-        self.db = sqlite3.connect(filename)
+        self.db = sqlite3.connect(filename, cached_statements=self.statement_cache_size)
         self.cursor = self.db.cursor()
         self.create_table_if_not_exists()
+        self.migrate_schema()
         self.update_idcache()
 
     def __del__(self):
@@ -60,6 +73,23 @@ class FeedDatabase:
     def keys(self):
         return self.idcache
 
+    def get_items(self, item_ids, fields=None):
+        fields = self.dbfields if fields is None else ['id'] + list(fields)
+        return {row[0]: dict(zip(fields, row))
+                for row in self.select_by_ids(item_ids, ', '.join(fields))}
+
+    def select_by_ids(self, item_ids, columns='*'):
+        for chunk, placeholders in self.chunk_ids(item_ids):
+            self.cursor.execute(f'SELECT {columns} FROM feeds WHERE id IN ({placeholders})',
+                                chunk)
+            yield from self.cursor.fetchall()
+
+    def chunk_ids(self, item_ids):
+        item_ids = list(item_ids)
+        for i in range(0, len(item_ids), self.max_query_params):
+            chunk = item_ids[i:i+self.max_query_params]
+            yield chunk, ', '.join(['?'] * len(chunk))
+
     def create_table_if_not_exists(self):
         self.cursor.execute('CREATE TABLE IF NOT EXISTS feeds (id TEXT UNIQUE, starred INTEGER, '
                             'title TEXT COLLATE NOCASE, content TEXT, '
@@ -67,12 +97,26 @@ class FeedDatabase:
                             'published INTEGER, link TEXT, mediaUrl TEXT, '
                             'label INTEGER, score REAL, broadcasted INTEGER, '
                             'tldr TEXT)')
-        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_feeds_id ON feeds(id)')
         self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_feeds_published ON feeds(published)')
         self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_feeds_starred ON feeds(starred)')
         self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_feeds_label ON feeds(label)')
         self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_feeds_score ON feeds(score)')
         self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_feeds_broadcasted ON feeds(broadcasted)')
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS s2_cache (key TEXT PRIMARY KEY, '
+                            'response TEXT, retrieved INTEGER)')
+
+    def migrate_schema(self):
+        version = self.cursor.execute('PRAGMA user_version').fetchone()[0]
+        if version >= self.schema_version:
+            return
+
+        if version < 1:
+            # The UNIQUE constraint already indexes id; a second index on it
+            # only doubled the work of every insert.
+            self.cursor.execute('DROP INDEX IF EXISTS idx_feeds_id')
+
+        self.cursor.execute(f'PRAGMA user_version = {self.schema_version}')
+        self.db.commit()
 
     def update_idcache(self):
         self.cursor.execute('SELECT id FROM feeds')
@@ -82,18 +126,26 @@ class FeedDatabase:
         self.db.commit()
 
     def insert_item(self, item, starred=0, broadcasted=None, tldr=None):
-        content = remove_html_tags(item.content)
-        self.cursor.execute('INSERT INTO feeds VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                            (item.item_id, starred, item.title, content, item.author,
-                             item.origin, item.published, item.href, item.mediaUrl,
-                             None, None, broadcasted, tldr))
-        self.idcache.add(item.item_id)
+        self.insert_items([item], starred=starred, broadcasted=broadcasted, tldr=tldr)
+
+    def insert_items(self, items, starred=0, broadcasted=None, tldr=None):
+        rows = [(item.item_id, starred, item.title, remove_html_tags(item.content),
+                 item.author, item.origin, item.published, item.href, item.mediaUrl,
+                 None, None, broadcasted, tldr)
+                for item in items]
+        self.cursor.executemany('INSERT INTO feeds VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                rows)
+        self.idcache.update(row[0] for row in rows)
 
     def get_formatted_item(self, item_id):
         self.cursor.execute('SELECT * FROM feeds WHERE id = ?', (item_id,))
         item = self.cursor.fetchone()
         return self.llm_input_format.format(item=item)
 
+    def get_formatted_items(self, item_ids):
+        items = {row[0]: row for row in self.select_by_ids(item_ids)}
+        return [self.llm_input_format.format(item=items[item_id]) for item_id in item_ids]
+
     def build_dataframe_from_results(self):
         return pd.DataFrame(self.cursor.fetchall(), columns=self.dbfields).set_index('id')
 
@@ -105,19 +157,23 @@ class FeedDatabase:
         self.cursor.execute('UPDATE feeds SET label = ? WHERE id = ?', (label, item_id))
 
     def update_score(self, item_id, score):
-        self.cursor.execute('UPDATE feeds SET score = ? WHERE id = ?', (float(score), item_id))
+        self.update_scores([(item_id, score)])
+
+    def update_scores(self, scores):
+        self.cursor.executemany('UPDATE feeds SET score = ? WHERE id = ?',
+                                ((float(score), item_id) for item_id, score in scores))
 
     def update_broadcasted(self, item_id, timemark):
         self.cursor.execute('UPDATE feeds SET broadcasted = ? WHERE id = ?', (timemark, item_id))
 
-    def update_tldr(self, item_id, tldr):
-        self.cursor.execute('UPDATE feeds SET tldr = ? WHERE id = ?', (tldr, item_id))
-
-    def update_author(self, item_id, author):
-        self.cursor.execute('UPDATE feeds SET author = ? WHERE id = ?', (author, item_id))
-
-    def update_origin(self, item_id, origin):
-        self.cursor.execute('UPDATE feeds SET origin = ? WHERE id = ?', (origin, item_id))
+    def update_s2_infos(self, rows):
+        # rows: (item_id, tldr, author, origin). Fields given as None keep
+        # their current values.
+        self.cursor.executemany('UPDATE feeds SET tldr = COALESCE(?, tldr), '
+                                'author = COALESCE(?, author), '
+                                'origin = COALESCE(?, origin) WHERE id = ?',
+                                ((tldr, author, origin, item_id)
+                                 for item_id, tldr, author, origin in rows))
 
     def get_unscored_items(self):
         self.cursor.execute('SELECT id FROM feeds WHERE score IS NULL')
@@ -137,9 +193,7 @@ class FeedDatabase:
 
         blacklisted = set()
         if remove_duplicated is not None:
-            for item_id in matches.index:
-                if self.check_broadcasted(item_id, remove_duplicated):
-                    blacklisted.add(item_id)
+            blacklisted = self.check_broadcasted(matches.index, remove_duplicated)
 
         if len(blacklisted) > 0:
             matches = matches.drop(blacklisted)
@@ -152,18 +206,52 @@ class FeedDatabase:
         matches = self.build_dataframe_from_results()
         return self.filter_duplicates(matches, remove_duplicated)
 
-    def check_broadcasted(self, item_id, since):
-        self.cursor.execute('SELECT COUNT(b.broadcasted) FROM feeds a, feeds b '
-                            'WHERE a.id = ? AND b.published >= ? AND '
-                            'a.id != b.id AND a.title = b.title AND '
-                            'b.broadcasted > 0', (item_id, since))
-        dup_broadcasted = self.cursor.fetchone()[0]
-        if dup_broadcasted > 0:
+    def check_broadcasted(self, item_ids, since):
+        dup_broadcasted = set()
+        for chunk, placeholders in self.chunk_ids(item_ids):
+            self.cursor.execute('SELECT DISTINCT a.id FROM feeds a, feeds b '
+                                f'WHERE a.id IN ({placeholders}) AND b.published >= ? AND '
+                                'a.id != b.id AND a.title = b.title AND '
+                                'b.broadcasted > 0', (*chunk, since))
+            dup_broadcasted.update(row[0] for row in self.cursor.fetchall())
+
+        if dup_broadcasted:
             # Mark duplicates as blacklisted
-            self.cursor.execute('UPDATE feeds SET broadcasted = 0 WHERE id = ?', (item_id,))
+            self.cursor.executemany('UPDATE feeds SET broadcasted = 0 WHERE id = ?',
+                                    [(item_id,) for item_id in dup_broadcasted])
             self.commit()
 
-        return dup_broadcasted > 0
+        return dup_broadcasted
+
+    def get_s2_cache(self, keys, no_match_since):
+        matches = {}
+        for chunk, placeholders in self.chunk_ids(keys):
+            self.cursor.execute('SELECT key, response, retrieved FROM s2_cache '
+                                f'WHERE key IN ({placeholders})', chunk)
+            for key, response, retrieved in self.cursor.fetchall():
+                if response is not None:
+                    matches[key] = json.loads(response)
+                elif retrieved >= no_match_since:
+                    matches[key] = None
+        return matches
+
+    def cache_s2_match(self, key, match, timestamp):
+        response = json.dumps(match) if match is not None else None
+        self.cursor.execute('INSERT OR REPLACE INTO s2_cache VALUES (?, ?, ?)',
+                            (key, response, timestamp))
+
+    def expire_s2_cache(self, before):
+        self.cursor.execute('DELETE FROM s2_cache WHERE retrieved < ?', (before,))
+
+    def get_broadcast_candidates(self, threshold, since, starred_since,
+                                 remove_duplicated=None):
+        # New interesting items and newly starred items in a single scan.
+        self.cursor.execute('SELECT * FROM feeds WHERE broadcasted IS NULL AND '
+                            '((score > ? AND published >= ?) OR '
+                            '(starred > 0 AND published >= ?))',
+                            (threshold, since, starred_since))
+        matches = self.build_dataframe_from_results()
+        return self.filter_duplicates(matches, remove_duplicated)
 
     def get_star_status(self, since, till):
         self.cursor.execute('SELECT id, starred FROM feeds WHERE published >= ? '
@@ -176,3 +264,7 @@ class FeedDatabase:
 
 def remove_html_tags(text, pattern=re.compile('<.*?>')):
     return pattern.sub(' ', text)
+
+def nocase_key(text, table=str.maketrans(string.ascii_uppercase, string.ascii_lowercase)):
+    # Folds case like SQLite's NOCASE collation does, i.e. for ASCII letters only.
+    return text.translate(table)
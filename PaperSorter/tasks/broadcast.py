@@ -21,17 +21,23 @@
 # THE SOFTWARE.
 #
 
-from ..feed_database import FeedDatabase
+from ..feed_database import FeedDatabase, nocase_key
 from ..log import log, initialize_logging
 import requests
-import pandas as pd
+import urllib3
 import click
+import random
 import time
 import re
 import os
 
 SLACK_ENDPOINT_KEY = 'PAPERSORTER_WEBHOOK_URL'
 SLACK_HEADER_MAX_LENGTH = 150
+SLACK_MAX_ATTEMPTS = 5
+SLACK_RETRY_MAX_DELAY = 60
+SLACK_REQUEST_TIMEOUT = (10, 30) # seconds to connect, seconds to wait for the response
+SLACK_REQUEST_HEADERS = {'Content-type': 'application/json'}
+WHITESPACE_RE = re.compile(r'\s+')
 
 class SlackNotificationError(Exception):
     pass
@@ -56,9 +62,7 @@ def limit_text_length(text, limit):
         return text[:limit-3] + '…'
     return text
 
-def send_slack_notification(endpoint_url, item, msgopts):
-    header = {'Content-type': 'application/json'}
-
+def send_slack_notification(endpoint_url, item, msgopts, session=None):
     # Add title block
     title = normalize_text(item['title'])
     blocks = [
@@ -130,7 +134,9 @@ def send_slack_notification(endpoint_url, item, msgopts):
         'unfurl_media': False,
     }
 
-    response = requests.post(endpoint_url, headers=header, json=data)
+    poster = requests if session is None else session
+    response = post_with_retries(poster, endpoint_url, headers=SLACK_REQUEST_HEADERS,
+                                 json=data, timeout=SLACK_REQUEST_TIMEOUT)
 
     if response.status_code == 200:
         pass
@@ -146,8 +152,42 @@ def send_slack_notification(endpoint_url, item, msgopts):
                   f'{response.status_code}')
         raise SlackNotificationError
 
+def is_connect_failure(exc):
+    # True if the connection could not be established, so the message was
+    # never sent. Refused connections, DNS failures and connect timeouts are
+    # all reported by urllib3 as ConnectTimeoutError or one of its subclasses.
+    reason = getattr(exc.args[0], 'reason', exc.args[0]) if exc.args else None
+    return isinstance(reason, urllib3.exceptions.ConnectTimeoutError)
+
+def post_with_retries(poster, url, **kwargs):
+    # A webhook post is not idempotent: after a dropped connection or a 5xx,
+    # the message may already be in the channel. Only rate limits (429) and
+    # failures to connect, where nothing was delivered, are retried. Other
+    # responses are returned at once.
+    for attempt in range(SLACK_MAX_ATTEMPTS):
+        last_try = attempt == SLACK_MAX_ATTEMPTS - 1
+        try:
+            response = poster.post(url, **kwargs)
+        except requests.exceptions.ConnectionError as exc:
+            if last_try or not is_connect_failure(exc):
+                raise
+            retry_after = None
+        else:
+            if last_try or response.status_code != 429:
+                return response
+            retry_after = response.headers.get('Retry-After')
+
+        # Honor the delay requested by Slack, otherwise back off with jitter.
+        if retry_after is not None and retry_after.isdigit():
+            delay = int(retry_after)
+        else:
+            delay = 2 ** attempt + random.random()
+        delay = min(delay, SLACK_RETRY_MAX_DELAY)
+        log.debug(f'Retrying the Slack webhook in {delay:.1f} seconds.')
+        time.sleep(delay)
+
 def normalize_text(text):
-    return re.sub(r'\s+', ' ', text).strip()
+    return WHITESPACE_RE.sub(' ', text).strip()
 
 @click.option('--feed-database', default='feeds.db', help='Feed database file.')
 @click.option('--days', default=7, help='Number of days to look back.')
@@ -172,21 +212,32 @@ def main(feed_database, days, score_threshold, score_model_name,
     endpoint = os.environ[SLACK_ENDPOINT_KEY]
     feeddb = FeedDatabase(feed_database)
 
-    newitems = feeddb.get_new_interesting_items(score_threshold, since,
-                                                remove_duplicated=since)
-    newstars = feeddb.get_newly_starred_items(since=0, remove_duplicated=since)
-    if len(newstars) > 0:
-        newitems = (
-            pd.concat([newitems, newstars]) if len(newitems) > 0 else newstars)
+    newitems = feeddb.get_broadcast_candidates(score_threshold, since, starred_since=0,
+                                               remove_duplicated=since)
     log.info(f'Found {len(newitems)} new items to broadcast.')
 
-    for item_id, info in newitems.iterrows():
-        log.info(f'Sending notification to Slack for "{info["title"]}"')
-        normalize_item_for_display(info, max_content_length)
-        try:
-            send_slack_notification(endpoint, info, message_options)
-        except SlackNotificationError:
-            pass
-        else:
-            feeddb.update_broadcasted(item_id, int(time.time()))
-            feeddb.commit()
+    # Titles sent during this run. The database check only sees duplicates
+    # broadcasted by earlier runs.
+    broadcasted_titles = set()
+
+    # Reuse one connection to the webhook for all messages of this run.
+    with requests.Session() as session:
+        for item_id, info in newitems.iterrows():
+            # Same comparison as the title check in the database (NOCASE).
+            title_key = nocase_key(info['title'])
+            if title_key in broadcasted_titles:
+                log.info(f'Skipping duplicate of a broadcasted item: "{info["title"]}"')
+                feeddb.update_broadcasted(item_id, 0)
+                feeddb.commit()
+                continue
+
+            log.info(f'Sending notification to Slack for "{info["title"]}"')
+            normalize_item_for_display(info, max_content_length)
+            try:
+                send_slack_notification(endpoint, info, message_options, session=session)
+            except SlackNotificationError:
+                pass
+            else:
+                feeddb.update_broadcasted(item_id, int(time.time()))
+                feeddb.commit()
+                broadcasted_titles.add(title_key)
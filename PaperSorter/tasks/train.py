@@ -24,10 +24,6 @@
 from ..feed_database import FeedDatabase
 from ..embedding_database import EmbeddingDatabase
 from ..log import log, initialize_logging
-from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import roc_auc_score
-import xgboost as xgb
 import pandas as pd
 import numpy as np
 import click
@@ -68,6 +64,11 @@ def main(feed_database, embedding_database, output, rounds, output_feedback,
          log_file, quiet):
     initialize_logging(task='train', logfile=log_file, quiet=quiet)
 
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.model_selection import train_test_split
+    from sklearn.metrics import roc_auc_score
+    import xgboost as xgb
+
     feeddb = FeedDatabase(feed_database)
     embeddingdb = EmbeddingDatabase(embedding_database)
 
@@ -107,10 +108,11 @@ def main(feed_database, embedding_database, output, rounds, output_feedback,
     )
 
     log.info('Saving model...')
-    pickle.dump({
-        'model': model,
-        'scaler': scaler,
-    }, open(output, 'wb'))
+    with open(output, 'wb') as f:
+        pickle.dump({
+            'model': model,
+            'scaler': scaler,
+        }, f)
 
     log.info('Evaluating regression model...')
     y_testpred = model.predict(dtest_reg)
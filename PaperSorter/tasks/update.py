@@ -25,11 +25,18 @@ from ..providers.theoldreader import Connection, ItemsSearch
 from ..feed_database import FeedDatabase
 from ..embedding_database import EmbeddingDatabase
 from ..log import log, initialize_logging
-from openai import OpenAI
-import xgboost as xgb
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from datetime import datetime, timedelta
+from itertools import islice
+import threading
+import logging
+import random
+import re
 import time
 import requests
+import functools
 import pickle
 import click
 import os
@@ -37,23 +44,76 @@ import os
 FEED_UPDATE_LIMIT_REGULAR = 200
 FEED_UPDATE_LIMIT_FULL = 1000
 FEED_EPOCH = 2020, 1, 1
+FEED_COMMIT_INTERVAL = 10 # pages
 
 OPENAI_API_URL = 'https://api.openai.com/v1'
 OPENAI_EMBEDDING_MODEL = 'text-embedding-3-large'
-
+EMBEDDING_MAX_WORKERS = 2
+SCORE_BATCH_SIZE = 2048
+
+S2_API_URL = 'http://api.semanticscholar.org/graph/v1/paper/search/match'
+S2_MAX_WORKERS = 4
+S2_MAX_RETRIES = 5
+S2_RETRY_MAX_DELAY = 60
+S2_CACHE_TTL = 30 * 86400
+S2_CACHE_TTL_NO_MATCH = 7 * 86400
+S2_COMMIT_INTERVAL = 50
 S2_VENUE_UPDATE_BLACKLIST = {
     'Molecules and Cells', # Molecular Cell (Cell Press) is incorrectly matched to this.
 }
-
-def batched(iterable, n):
-    items = []
-    for item in iterable:
-        items.append(item)
-        if len(items) == n:
-            yield items
-            items = []
-    if items:
-        yield items
+VENUE_NORMALIZE_RE = re.compile(r'\W+')
+
+def normalize_venue(venue):
+    # Case, spacing and punctuation variants of a venue map to the same key.
+    return VENUE_NORMALIZE_RE.sub('', venue).casefold()
+
+S2_VENUE_UPDATE_BLACKLIST_KEYS = frozenset(
+    normalize_venue(venue) for venue in S2_VENUE_UPDATE_BLACKLIST)
+
+class RateLimiter:
+    # Spaces the calls to wait() from all threads at least `interval` seconds apart.
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+try:
+    from itertools import batched
+except ImportError: # Python < 3.12
+    def batched(iterable, n):
+        it = iter(iterable)
+        while batch := tuple(islice(it, n)):
+            yield batch
+
+def prefetched(iterable):
+    # Produces the next element in a background thread while the current one
+    # is consumed (e.g. downloads the next page while this one is stored). The
+    # thread starts with the iteration, and a single element is requested
+    # ahead at any time.
+    def consume():
+        it = iter(iterable)
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            future = executor.submit(next, it, finished)
+            while True:
+                element = future.result()
+                if element is finished:
+                    return
+                future = executor.submit(next, it, finished)
+                yield element
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    finished = object()
+    return consume()
 
 def update_star_status(db, items):
     time_begin = min(it.published for it in items) - 1
@@ -82,6 +142,7 @@ def retrieve_items_into_db(db, iterator, starred, date_cutoff, stop_at_no_new_it
                            bulk_loading=False):
     default_broadcasted = 0 if bulk_loading else None
     progress_log = log.info if bulk_loading else log.debug
+    log_retrieved = log.isEnabledFor(logging.DEBUG)
 
     for page, items in enumerate(iterator):
         progress_log(f'Processing page {page+1}')
@@ -89,10 +150,10 @@ def retrieve_items_into_db(db, iterator, starred, date_cutoff, stop_at_no_new_it
             # Update starred status for the latest items only
             update_star_status(db, items)
 
-        newitems = 0
+        newitems = {}
 
         for item in items:
-            if item in db:
+            if item in db or item.item_id in newitems:
                 continue
 
             if item.title is None:
@@ -101,16 +162,21 @@ def retrieve_items_into_db(db, iterator, starred, date_cutoff, stop_at_no_new_it
                 log.debug(f'Skipping item {item.item_id} due to date cutoff {item.published}.')
                 continue
 
-            date_formatted = datetime.fromtimestamp(item.published).strftime('%Y-%m-%d %H:%M:%S')
-            log.debug(f'Retrieved: [{date_formatted}] {item.title}')
-            db.insert_item(item, starred=starred, broadcasted=default_broadcasted)
-            newitems += 1
+            if log_retrieved:
+                date_formatted = datetime.fromtimestamp(item.published).strftime('%Y-%m-%d %H:%M:%S')
+                log.debug(f'Retrieved: [{date_formatted}] {item.title}')
+            newitems[item.item_id] = item
 
-        if newitems == 0 and stop_at_no_new_items:
+        db.insert_items(newitems.values(), starred=starred, broadcasted=default_broadcasted)
+
+        if not newitems and stop_at_no_new_items:
             log.debug(f'Stopping at page {page+1} due to no new items.')
             break
 
-        db.commit()
+        if (page + 1) % FEED_COMMIT_INTERVAL == 0:
+            db.commit()
+
+    db.commit()
 
 def update_feeds(get_full_list, feeddb, date_cutoff, bulk_loading, credential):
     conn = Connection(email=credential['TOR_EMAIL'], password=credential['TOR_PASSWORD'])
@@ -123,18 +189,32 @@ def update_feeds(get_full_list, feeddb, date_cutoff, bulk_loading, credential):
     stop_at_no_new_items = not get_full_list
     update_limit = FEED_UPDATE_LIMIT_FULL if get_full_list else FEED_UPDATE_LIMIT_REGULAR
 
-    retrieve_items_into_db(feeddb, searcher.get_starred_only(limit_items=update_limit), starred=1,
-                           date_cutoff=date_cutoff, stop_at_no_new_items=stop_at_no_new_items,
-                           bulk_loading=bulk_loading)
-    retrieve_items_into_db(feeddb, searcher.get_all(limit_items=update_limit), starred=0,
-                           date_cutoff=date_cutoff, stop_at_no_new_items=stop_at_no_new_items,
-                           bulk_loading=bulk_loading)
+    # The first pages of both streams are downloaded concurrently. Starred
+    # items still go into the database first.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        starred_search = executor.submit(searcher.get_starred_only, limit_items=update_limit)
+        all_search = executor.submit(searcher.get_all, limit_items=update_limit)
+        starred_pages = starred_search.result()
+        all_pages = all_search.result()
+
+    # A full listing reads every page, so the next one is downloaded while the
+    # current one is written. A regular update usually stops at the first page
+    # without new items, where reading ahead would only fetch a page to discard.
+    if get_full_list:
+        starred_pages = prefetched(starred_pages)
+        all_pages = prefetched(all_pages)
+
+    retrieve_items_into_db(feeddb, starred_pages, starred=1, date_cutoff=date_cutoff,
+                           stop_at_no_new_items=stop_at_no_new_items, bulk_loading=bulk_loading)
+    retrieve_items_into_db(feeddb, all_pages, starred=0, date_cutoff=date_cutoff,
+                           stop_at_no_new_items=stop_at_no_new_items, bulk_loading=bulk_loading)
 
 def update_embeddings(embeddingdb, batch_size, api_key, feeddb, bulk_loading=False,
                       force_reembed=False):
-    keystoupdate = feeddb.keys().copy()
-    if not force_reembed:
-        keystoupdate -= embeddingdb.keys()
+    if force_reembed:
+        keystoupdate = feeddb.keys().copy()
+    else:
+        keystoupdate = feeddb.keys() - embeddingdb.keys()
     progress_log = log.info if bulk_loading else log.debug
 
     log.info(f'Items: feed_db:{len(feeddb)} '
@@ -145,62 +225,176 @@ def update_embeddings(embeddingdb, batch_size, api_key, feeddb, bulk_loading=Fal
 
     log.info('Updating embeddings...')
 
+    from openai import OpenAI
     client = OpenAI(api_key=api_key, base_url=OPENAI_API_URL)
     model_name = OPENAI_EMBEDDING_MODEL
 
-    with embeddingdb.write_batch() as writer:
+    # API requests run in the background while the next batch is read from
+    # the feed database and the finished ones are written out.
+    with embeddingdb.write_batch() as writer, \
+            ThreadPoolExecutor(max_workers=EMBEDDING_MAX_WORKERS) as executor:
+        pending = deque()
+
         for bid, batch in enumerate(batched(keystoupdate, batch_size)):
             progress_log(f'Updating embedding: batch {bid+1} ...')
 
-            items = [feeddb.get_formatted_item(item_id) for item_id in batch]
-            embresults = client.embeddings.create(model=model_name, input=items)
+            items = feeddb.get_formatted_items(batch)
+            request = executor.submit(client.embeddings.create, model=model_name, input=items)
+            pending.append((batch, request))
 
-            for item_id, result in zip(batch, embresults.data):
-                writer[item_id] = result.embedding
+            if len(pending) >= EMBEDDING_MAX_WORKERS:
+                store_embeddings(writer, *pending.popleft())
+
+        while pending:
+            store_embeddings(writer, *pending.popleft())
 
     return len(keystoupdate)
 
+def store_embeddings(writer, batch, request):
+    for item_id, result in zip(batch, request.result().data):
+        writer[item_id] = result.embedding
+
 def update_s2_info(feeddb, s2_config, dateoffset=60):
     unscored_items = feeddb.get_unscored_items()
     if not unscored_items:
         return
 
-    api_headers = {'X-API-KEY': s2_config['S2_API_KEY']}
+    # One session for all workers keeps the connections to the API alive.
+    session = requests.Session()
+    session.headers.update({'X-API-KEY': s2_config['S2_API_KEY']})
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=S2_MAX_WORKERS)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
 
     log.info('Retrieving Semantic Scholar information...')
 
-    for feed_id in unscored_items:
-        time.sleep(s2_config['S2_THROTTLE'])
-
-        feedinfo = feeddb[feed_id]
-        pubdate = datetime.fromtimestamp(feedinfo['published'])
-
-        date_from = pubdate - timedelta(days=dateoffset)
-        date_to = pubdate + timedelta(days=dateoffset)
-        date_range = (f'{date_from.year}-{date_from.month:02d}-{date_from.day:02d}:'
-                      f'{date_to.year}-{date_to.month:02d}-{date_to.day:02d}')
-
-        search_query = {
-            'query': feedinfo['title'],
-            'publicationDateOrYear': date_range,
-            'fields': 'title,url,authors,venue,publicationDate,tldr',
-        }
-        url = 'http://api.semanticscholar.org/graph/v1/paper/search/match'
-        r = requests.get(url, headers=api_headers, params=search_query).json()
-        if 'data' not in r or not r['data']:
-            continue
+    feedinfos = feeddb.get_items(unscored_items, fields=['title', 'published'])
 
-        s2feed = r['data'][0]
-        # s2feed['matchScore']
-        if s2feed['tldr'] and s2feed['tldr'].get('text'):
-            feeddb.update_tldr(feed_id, s2feed['tldr']['text'])
-        if s2feed['authors']:
-            feeddb.update_author(feed_id, format_authors(s2feed['authors']))
-        if (s2feed.get('venue') is not None and s2feed['venue'].strip() and
-                s2feed['venue'] not in S2_VENUE_UPDATE_BLACKLIST):
-            feeddb.update_origin(feed_id, s2feed['venue'])
+    # The same paper often arrives through several feeds. Look up each title
+    # only once and apply the match to all of its copies.
+    title_groups = {}
+    for feed_id in unscored_items:
+        title = feedinfos[feed_id]['title']
+        key = normalize_title(title) if title else feed_id
+        title_groups.setdefault(key, []).append(feed_id)
+    title_groups = list(title_groups.values())
+
+    # Items stay unscored until a model scores them, so the same lookups
+    # would otherwise be repeated on every update. Reuse recent answers.
+    now = int(time.time())
+    feeddb.expire_s2_cache(now - S2_CACHE_TTL)
+    queries = [make_s2_query(feedinfos[feed_ids[0]], dateoffset) for feed_ids in title_groups]
+    cache_keys = [s2_cache_key(search_query) for search_query in queries]
+    cached = feeddb.get_s2_cache(cache_keys, no_match_since=now - S2_CACHE_TTL_NO_MATCH)
+    misses = [search_query for search_query, key in zip(queries, cache_keys)
+              if key not in cached]
+    log.debug(f'S2 lookups: {len(queries)} titles, {len(misses)} not cached')
+
+    # Requests are issued from a few threads so that the response latency
+    # overlaps with the throttling interval. The database is only touched
+    # from this thread.
+    throttle = RateLimiter(s2_config['S2_THROTTLE'])
+    executor = ThreadPoolExecutor(max_workers=S2_MAX_WORKERS)
+    pending_updates = []
+    failed = 0
+    try:
+        responses = executor.map(
+            lambda search_query: query_s2_match(search_query, session, throttle), misses)
 
+        for i, (feed_ids, key) in enumerate(zip(title_groups, cache_keys)):
+            if key in cached:
+                s2feed = cached[key]
+            else:
+                cacheable, s2feed = next(responses)
+                if cacheable:
+                    feeddb.cache_s2_match(key, s2feed, now)
+                else:
+                    failed += 1
+
+            if s2feed is not None:
+                pending_updates.extend(make_s2_updates(feed_ids, s2feed))
+
+            if (i + 1) % S2_COMMIT_INTERVAL == 0:
+                feeddb.update_s2_infos(pending_updates)
+                pending_updates.clear()
+                feeddb.commit()
+
+        if failed:
+            log.warning(f'{failed} of {len(misses)} Semantic Scholar lookups failed; '
+                        'they will be retried on the next update.')
+    finally:
+        # Keep what was retrieved so far even if a request failed.
+        feeddb.update_s2_infos(pending_updates)
         feeddb.commit()
+        executor.shutdown(wait=False, cancel_futures=True)
+        session.close()
+
+def make_s2_updates(feed_ids, s2feed):
+    # s2feed['matchScore']
+    tldr = author = origin = None
+    if s2feed['tldr'] and s2feed['tldr'].get('text'):
+        tldr = s2feed['tldr']['text']
+    if s2feed['authors']:
+        author = format_authors(s2feed['authors'])
+    if (s2feed.get('venue') is not None and s2feed['venue'].strip() and
+            normalize_venue(s2feed['venue']) not in S2_VENUE_UPDATE_BLACKLIST_KEYS):
+        origin = s2feed['venue']
+
+    if tldr is None and author is None and origin is None:
+        return []
+
+    return [(feed_id, tldr, author, origin) for feed_id in feed_ids]
+
+def make_s2_query(feedinfo, dateoffset):
+    pubdate = datetime.fromtimestamp(feedinfo['published'])
+
+    date_from = pubdate - timedelta(days=dateoffset)
+    date_to = pubdate + timedelta(days=dateoffset)
+    date_range = (f'{date_from.year}-{date_from.month:02d}-{date_from.day:02d}:'
+                  f'{date_to.year}-{date_to.month:02d}-{date_to.day:02d}')
+
+    return {
+        'query': feedinfo['title'],
+        'publicationDateOrYear': date_range,
+        'fields': 'title,url,authors,venue,publicationDate,tldr',
+    }
+
+def s2_cache_key(search_query):
+    return (f'{normalize_title(search_query["query"] or "")}\t'
+            f'{search_query["publicationDateOrYear"]}')
+
+def query_s2_match(search_query, session, throttle):
+    for retry in range(S2_MAX_RETRIES):
+        throttle.wait()
+        r = session.get(S2_API_URL, params=search_query)
+        if r.status_code != 429 or retry == S2_MAX_RETRIES - 1:
+            break
+
+        # Rate limited. Wait as long as the API asks, otherwise back off with
+        # jitter so the workers don't retry in lockstep.
+        retry_after = r.headers.get('Retry-After')
+        if retry_after is not None and retry_after.isdigit():
+            delay = int(retry_after)
+        else:
+            delay = 2 ** retry + random.random()
+        time.sleep(min(delay, S2_RETRY_MAX_DELAY))
+
+    # Returns (cacheable, match). A 404 is the API's answer for a title with
+    # no match and is worth remembering; rate limits and server errors are not.
+    if r.status_code == 404:
+        return True, None
+    elif r.status_code != 200:
+        log.debug(f'S2 lookup failed with status {r.status_code}: {search_query["query"]}')
+        return False, None
+
+    r = r.json()
+    if 'data' not in r or not r['data']:
+        return True, None
+
+    return True, r['data'][0]
+
+def normalize_title(title):
+    return ' '.join(title.split()).casefold()
 
 def format_authors(authors, max_authors=4):
     assert max_authors >= 3
@@ -212,9 +406,30 @@ def format_authors(authors, max_authors=4):
         last_authors = ', '.join(a['name'] for a in authors[-2:])
         return first_authors + ', ..., ' + last_authors
 
-def score_new_feeds(feeddb, embeddingdb, prediction_model, force_rescore=False):
+def load_prediction_model(filename):
+    # The modification time is part of the cache key so that a retrained
+    # model replacing the file is picked up.
+    return load_prediction_model_file(filename, os.path.getmtime(filename))
+
+@functools.lru_cache(maxsize=4)
+def load_prediction_model_file(filename, mtime):
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+def standardize(emb, mean, scale, out):
+    # Equivalent to scaler.transform(emb), but writes the result into a reused
+    # float32 buffer instead of allocating float64 intermediates. XGBoost works
+    # on float32 anyway, so mean and scale are float32 too and the whole
+    # computation stays in single precision.
+    out[...] = emb
+    np.subtract(out, mean, out=out)
+    np.divide(out, scale, out=out)
+    return out
+
+def score_new_feeds(feeddb, embeddingdb, prediction_model, force_rescore=False,
+                    device=None, nthread=None, batch_size=SCORE_BATCH_SIZE):
     if force_rescore:
-        unscored = feeddb.keys()
+        unscored = list(feeddb.keys())
     else:
         unscored = feeddb.get_unscored_items()
 
@@ -224,24 +439,46 @@ def score_new_feeds(feeddb, embeddingdb, prediction_model, force_rescore=False):
     if not unscored:
         return
 
-    predmodel = pickle.load(open(prediction_model, 'rb'))
-    batchsize = 100
-
-    for bid, batch in enumerate(batched(unscored, batchsize)):
+    predmodel = load_prediction_model(prediction_model)
+    booster = predmodel['model']
+    booster_params = {}
+    if device is not None:
+        booster_params['device'] = device
+    if nthread is not None:
+        booster_params['nthread'] = nthread
+    if booster_params:
+        # The loaded model is shared through the cache, so tune a copy and
+        # leave the cached booster as it was saved.
+        booster = booster.copy()
+        booster.set_param(booster_params)
+    batchsize = batch_size
+    buf = None
+    scaler = predmodel['scaler']
+    mean = scaler.mean_.astype(np.float32)
+    scale = scaler.scale_.astype(np.float32)
+
+    # The next batch of embeddings is read while the current one is scored.
+    batches = prefetched((batch, embeddingdb[batch]) for batch in batched(unscored, batchsize))
+
+    for bid, (batch, emb) in enumerate(batches):
         log.debug(f'Scoring batch: {bid+1}')
-        emb = embeddingdb[batch]
-        emb_xrm = predmodel['scaler'].transform(emb)
+        if buf is None:
+            buf = np.empty((batchsize, emb.shape[1]), dtype=np.float32)
+        emb_xrm = standardize(emb, mean, scale, out=buf[:len(batch)])
+
+        # buf is float32 and C-contiguous, so the booster reads it without
+        # building a DMatrix for every batch.
+        scores = booster.inplace_predict(emb_xrm)
 
-        dmtx_pred = xgb.DMatrix(emb_xrm)
-        scores = predmodel['model'].predict(dmtx_pred)
+        feeddb.update_scores(zip(batch, scores.tolist()))
 
+        iteminfos = feeddb.get_items(batch, fields=['origin', 'title'])
         for item_id, score in zip(batch, scores):
-            feeddb.update_score(item_id, score)
-            iteminfo = feeddb[item_id]
+            iteminfo = iteminfos[item_id]
             log.info(f'New item: [{score:.2f}] {iteminfo["origin"]} / '
                      f'{iteminfo["title"]}')
 
-        feeddb.commit()
+    feeddb.commit()
 
 @click.option('--feed-database', default='feeds.db', help='Feed database file.')
 @click.option('--embedding-database', default='embeddings.db', help='Embedding database file.')
@@ -250,10 +487,17 @@ def score_new_feeds(feeddb, embeddingdb, prediction_model, force_rescore=False):
 @click.option('--prediction-model', default='model.pkl', help='Predictor model for scoring.')
 @click.option('--force-reembed', is_flag=True, help='Force recalculation of embeddings for all items.')
 @click.option('--force-rescore', is_flag=True, help='Force rescoring all items.')
+@click.option('--prediction-device', default=None,
+              help='XGBoost device for scoring (e.g. cpu, cuda).')
+@click.option('--prediction-threads', default=None, type=click.IntRange(min=1),
+              help='Number of XGBoost threads for scoring.')
+@click.option('--score-batch-size', default=SCORE_BATCH_SIZE, type=click.IntRange(min=1),
+              help='Number of items scored per batch.')
 @click.option('--log-file', default=None, help='Log file.')
 @click.option('-q', '--quiet', is_flag=True, help='Suppress log output.')
 def main(feed_database, embedding_database, batch_size, get_full_list,
-         prediction_model, force_reembed, force_rescore, log_file, quiet):
+         prediction_model, force_reembed, force_rescore, prediction_device,
+         prediction_threads, score_batch_size, log_file, quiet):
     initialize_logging(task='update', logfile=log_file, quiet=quiet)
 
     from dotenv import load_dotenv
@@ -287,6 +531,8 @@ def main(feed_database, embedding_database, batch_size, get_full_list,
                                     bulk_loading=False)
 
     if prediction_model != '' and num_updates > 0:
-        score_new_feeds(feeddb, embeddingdb, prediction_model, force_rescore)
+        score_new_feeds(feeddb, embeddingdb, prediction_model, force_rescore,
+                        device=prediction_device, nthread=prediction_threads,
+                        batch_size=score_batch_size)
 
     log.info('Update completed.')